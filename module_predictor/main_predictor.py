@@ -30,17 +30,20 @@ limitations under the License.
 from io import open
 from sklearn.externals import joblib
 import numpy
-import gensim
 from sys import stderr, stdin
 from optparse import OptionParser
 from utils import word2term, onto
-import json
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 import gzip
+from itertools import islice
 from sklearn.neighbors import NearestNeighbors
-from scipy.spatial.distance import cosine
-from sklearn.preprocessing import normalize
 
 
+COSINE_METRICS = ('cosine', 'cosine-brute')
+
 def metric_internal(metric):
     if metric == 'cosine':
         return 'euclidean'
@@ -48,40 +51,164 @@ def metric_internal(metric):
         return 'cosine'
     return metric
 
-def metric_norm(metric, concept_vectors):
+def metric_algorithm(metric):
+    # trees degenerate in high dimension, the brute-force search is a single BLAS matrix product
+    if metric in COSINE_METRICS:
+        return 'brute'
+    return 'auto'
+
+def l2_normalize_inplace(vectors):
+    """
+    Description: L2-normalize the rows of a float matrix in place, null rows are left unchanged.
+    :param vectors: A float matrix (n_rows, n_features).
+    :return: The same matrix.
+    """
+    norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+    numpy.maximum(norms, 1e-12, out=norms)
+    vectors /= norms
+    return vectors
+
+def metric_norm(metric, vectors):
     if metric == 'cosine':
-        return normalize(concept_vectors)
-    return concept_vectors
+        return l2_normalize_inplace(numpy.array(vectors, dtype=numpy.float32))
+    return vectors
 
-def metric_sim(metric, d, vecTerm, vecConcept):
+def metric_sim(metric, d):
     if metric == 'cosine':
-        return 1 - cosine(vecTerm, vecConcept)
+        # queries and concepts are L2-normalized: ||a - b||^2 = 2 - 2 a.b
+        return 1 - 0.5 * d**2
     if metric == 'cosine-brute':
         return 1 - d
     return 1 / d
 
 
+# number of terms scored at once by the fused projection and cosine search
+PROJECTED_CHUNK = 1024
+
+
+# below this number of concepts, the exact sklearn search is used even if an approximate index is requested
+ANN_MIN_CONCEPTS = 5000
+
+ANN_METRICS = COSINE_METRICS + ('euclidean',)
+
+def check_search_options(metric, ann):
+    """
+    Description: Check that the nearest concepts search options are compatible with the metric, before anything is loaded.
+    :param metric: Distance metric.
+    :param ann: Use an approximate index.
+    """
+    if ann and metric not in ANN_METRICS:
+        raise Exception('metric not supported by the approximate index: ' + metric)
+
+def hnsw_index(metric, concept_matrix):
+    """
+    Description: Build an HNSW approximate nearest neighbors index over the concept vectors.
+    :param metric: Distance metric, one of ANN_METRICS.
+    :param concept_matrix: A matrix (n_concepts, n_features) of concept vectors.
+    :return: A hnswlib index whose labels are the row numbers of concept_matrix.
+    """
+    import hnswlib
+    if metric in COSINE_METRICS:
+        space = 'cosine'
+    else:
+        space = 'l2'
+    n, dim = concept_matrix.shape
+    index = hnswlib.Index(space=space, dim=dim)
+    index.init_index(max_elements=n, M=16, ef_construction=200)
+    index.add_items(concept_matrix)
+    index.set_ef(50)
+    return index
+
 
 class VSONN(NearestNeighbors):
-    def __init__(self, vso, metric):
-        NearestNeighbors.__init__(self, algorithm='auto', metric=metric_internal(metric))
+    def __init__(self, vso, metric, ann=False, n_jobs=1):
+        check_search_options(metric, ann)
+        NearestNeighbors.__init__(self, algorithm=metric_algorithm(metric), metric=metric_internal(metric), n_jobs=n_jobs)
         self.original_metric = metric
         self.vso = vso
+        self.ann = ann
         self.concepts = tuple(vso.keys())
-        self.concept_vectors = list(vso.values())
-        self.fit(metric_norm(metric, self.concept_vectors))
+        # one contiguous (n_concepts, n_features) matrix, rows in the order of self.concepts
+        self.concept_vectors = numpy.ascontiguousarray(list(vso.values()), dtype=numpy.float32)
+        if metric in COSINE_METRICS:
+            # the cosine metrics do not depend on the norms, the raw vectors are still in vso
+            l2_normalize_inplace(self.concept_vectors)
+        self.ann_index = None
+        if ann and len(self.concepts) >= ANN_MIN_CONCEPTS:
+            self.ann_index = hnsw_index(metric, self.concept_vectors)
+        else:
+            self.fit(self.concept_vectors)
 
     def nearest_concept(self, vecTerm):
-        r = self.kneighbors([vecTerm], 1, return_distance=True)
-        #stderr.write('r = %s\n' % str(r))
-        d = r[0][0][0]
-        idx = r[1][0][0]
-        return self.concepts[idx], metric_sim(self.original_metric, d, vecTerm, self.concept_vectors[idx])
+        """
+        Description: Search the nearest concept of a single vector, for callers that can not batch their queries.
+        :param vecTerm: A vector in the VSO.
+        :return: The id of the nearest concept and its similarity with vecTerm.
+        """
+        concepts, sims = self.nearest_concepts(numpy.asarray([vecTerm], dtype=numpy.float32))
+        return concepts[0], sims[0]
+
+    def nearest_concepts(self, Xq):
+        """
+        Description: Search the nearest concept of every row of Xq in a single kneighbors call.
+        :param Xq: A matrix (n_queries, n_features) of vectors in the VSO.
+        :return: A list of concept ids and an array of similarities, in the same order as the rows of Xq.
+        """
+        if self.ann_index is not None:
+            idxs, dists = self.ann_index.knn_query(numpy.asarray(Xq, dtype=numpy.float32), k=1, num_threads=self.n_jobs)
+            if self.ann_index.space == 'cosine':
+                # hnswlib returns the cosine distance
+                sims = 1 - dists[:, 0]
+            else:
+                # hnswlib returns the squared euclidean distance
+                sims = metric_sim(self.original_metric, numpy.sqrt(dists[:, 0]))
+        else:
+            dists, idxs = self.kneighbors(metric_norm(self.original_metric, Xq), 1, return_distance=True)
+            sims = metric_sim(self.original_metric, dists[:, 0])
+        idxs = idxs[:, 0]
+        if self.original_metric in COSINE_METRICS:
+            # a null query has no direction, every concept ties: like the fused search, take the first one with
+            # similarity 0 whatever the search
+            null = ~numpy.any(Xq, axis=1)
+            idxs[null] = 0
+            sims[null] = 0
+        return [self.concepts[idx] for idx in idxs], sims
 
+    def nearest_projected_concepts(self, X, W, b):
+        """
+        Description: Search the nearest concept of the projection X.W^T + b of every row of X. With an exact cosine search,
+            the projection is fused with the scan: the scores are X.P + bias with P = W^T.C^T and bias = C.b precomputed
+            on the normalized concept vectors C, so that the projected vectors are never built. P costs as much as
+            projecting n_features terms, so batches with fewer terms are projected first.
+        :param X: A matrix (n_queries, n_features) of term vectors.
+        :param W: Coefficients (n_targets, n_features) of the linear projection from the VST to the VSO.
+        :param b: Intercept (n_targets,) of the linear projection.
+        :return: A list of concept ids and an array of similarities, in the same order as the rows of X.
+        """
+        if self.original_metric not in COSINE_METRICS or self.ann_index is not None or len(X) < W.shape[1]:
+            return self.nearest_concepts(numpy.dot(X, W.T) + b)
+        P = numpy.dot(W.T, self.concept_vectors.T)
+        bias = numpy.dot(self.concept_vectors, b)
+        # ||X.W^T + b||^2 = X.G.X^T + 2 X.W^T.b + b.b, in double precision
+        G = numpy.dot(W.T.astype(numpy.float64), W)
+        Wb = numpy.dot(W.T.astype(numpy.float64), b)
+        bb = numpy.dot(b.astype(numpy.float64), b)
+        idxs = numpy.empty(len(X), dtype=numpy.intp)
+        sims = numpy.empty(len(X), dtype=numpy.float32)
+        for start in range(0, len(X), PROJECTED_CHUNK):
+            chunk = X[start:start + PROJECTED_CHUNK]
+            rows = numpy.arange(len(chunk))
+            scores = numpy.dot(chunk, P) + bias
+            best = scores.argmax(axis=1)
+            norms = numpy.sqrt(numpy.maximum(numpy.einsum('ij,ij->i', numpy.dot(chunk, G), chunk) + 2 * numpy.dot(chunk, Wb) + bb, 0))
+            norms[norms == 0] = 1
+            idxs[start:start + len(chunk)] = best
+            sims[start:start + len(chunk)] = scores[rows, best] / norms
+        return [self.concepts[idx] for idx in idxs], sims
 
 
 
-def predictor(vst_onlyTokens, dl_terms, vso, transformationParam, metric, symbol='___'):
+def predictor(vst_onlyTokens, dl_terms, vso, transformationParam, metric, symbol='___', ann=False, n_jobs=1, vsoNN=None):
     """
     Description: From a calculated linear projection from the training module, applied it to predict a concept for each
         terms in parameters (dl_terms).
@@ -90,28 +217,31 @@ def predictor(vst_onlyTokens, dl_terms, vso, transformationParam, metric, symbol
     :param vso: A VSO (dict() -> {"id" : [vector], ...}
     :param transformationParam: LinearRegression object from Sklearn. Use the one calculated by the training module.
     :param symbol: Symbol delimiting the different token in a multi-words term.
+    :param ann: Use an HNSW approximate index (requires hnswlib) if the ontology has at least ANN_MIN_CONCEPTS concepts.
+    :param n_jobs: Number of jobs of the nearest concepts search (-1 for all the cores).
+    :param vsoNN: A VSONN already built on vso, to share between calls with the same VSO (built here if None). ann and
+        n_jobs only apply when vsoNN is None, otherwise the options of vsoNN are used.
     :return: A list of tuples containing : ("term form", "term id", "predicted concept id") and a list of unknown tokens
         containing in the terms from dl_terms.
     """
     lt_predictions = list()
 
-    vstTerm, l_unknownToken = word2term.wordVST2TermVST(vst_onlyTokens, dl_terms)
+    dl_forms = dict((id_term, word2term.getFormOfTerm(dl_terms[id_term], symbol)) for id_term in dl_terms.keys())
+    vstTerm, l_unknownToken = word2term.wordVST2TermVST(vst_onlyTokens, dl_terms, dl_forms)
 
-    result = dict()
+    if len(dl_terms) == 0:
+        return lt_predictions, l_unknownToken
 
-    vsoTerms = dict()
-    vsoNN = VSONN(vso, metric)
-    for id_term in dl_terms.keys():
-        termForm = word2term.getFormOfTerm(dl_terms[id_term], symbol)
-        x = vstTerm[termForm].reshape(1, -1)
-        vsoTerms[termForm] = transformationParam.predict(x)[0]
-        result[termForm] = vsoNN.nearest_concept(vsoTerms[termForm])
-
-    for id_term in dl_terms.keys():
-        termForm = word2term.getFormOfTerm(dl_terms[id_term], symbol)
-        cat, sim = result[termForm]
-        prediction = (termForm, id_term, cat, sim)
-        lt_predictions.append(prediction)
+    if vsoNN is None:
+        vsoNN = VSONN(vso, metric, ann, n_jobs)
+    l_ids = list(dl_terms.keys())
+    l_forms = [dl_forms[id_term] for id_term in l_ids]
+    X = numpy.asarray([vstTerm[termForm] for termForm in l_forms], dtype=numpy.float32)
+    # LinearRegression.predict as a matrix product, without sklearn's input validation
+    W = numpy.asarray(transformationParam.coef_, dtype=numpy.float32)
+    b = numpy.broadcast_to(numpy.asarray(transformationParam.intercept_, dtype=numpy.float32), W.shape[:1])
+    concepts, sims = vsoNN.nearest_projected_concepts(X, W, b)
+    lt_predictions.extend(zip(l_forms, l_ids, concepts, sims))
 
     return lt_predictions, l_unknownToken
 
@@ -120,8 +250,9 @@ def loadJSON(filename):
     if filename.endswith('.gz'):
         f = gzip.open(filename)
     else:
-        f = open(filename, encoding='utf-8')
-    result = json.load(f)
+        f = open(filename, 'rb')
+    # parse raw bytes, orjson only accepts UTF-8 input anyway
+    result = json_loads(f.read())
     f.close()
     return result;
 
@@ -138,6 +269,8 @@ class Predictor(OptionParser):
         self.add_option('--output', action='append', type='string', dest='output', help='file where to write predictions')
 
         self.add_option('--metric', action='store', type='string', dest='metric', default='cosine', help='distance metric to use (default: %default)')
+        self.add_option('--ann', action='store_true', dest='ann', default=False, help='use an approximate nearest neighbors index (hnswlib) for ontologies with at least %d concepts' % ANN_MIN_CONCEPTS)
+        self.add_option('--n-jobs', action='store', type='int', dest='n_jobs', default=1, help='number of parallel jobs of the nearest concepts search, -1 for all the cores (default: %default)')
 
     def run(self):
         options, args = self.parse_args()
@@ -166,34 +299,55 @@ class Predictor(OptionParser):
             stderr.write('defaulting %d factors to 1.0\n' % n)
             stderr.flush()
             options.factors.extend([1.0]*n)
+        check_search_options(options.metric, options.ann)
+        l_terms = list()
+        for terms_i in options.terms:
+            stderr.write('loading terms: %s\n' % terms_i)
+            stderr.flush()
+            l_terms.append(loadJSON(terms_i))
+        # only the vectors of the tokens found in the terms are kept
+        tokens = set(token for terms in l_terms for l_tokens in terms.values() for token in l_tokens)
         if options.word_vectors is not None:
             stderr.write('loading word embeddings: %s\n' % options.word_vectors)
             stderr.flush()
-            word_vectors = loadJSON(options.word_vectors)
+            all_vectors = loadJSON(options.word_vectors)
+            # keep at least one vector so that the size of the VST is still known when no token is in the vocabulary
+            l_known = [k for k in tokens if k in all_vectors] or list(islice(all_vectors, 1))
+            word_vectors = dict((k, numpy.asarray(all_vectors[k], dtype=numpy.float32)) for k in l_known)
+            del all_vectors
         elif options.word_vectors_bin is not None:
             stderr.write('loading word embeddings: %s\n' % options.word_vectors_bin)
             stderr.flush()
-            model = gensim.models.Word2Vec.load(options.word_vectors_bin)
-            word_vectors = dict((k, list(numpy.float_(npf32) for npf32 in model.wv[k])) for k in model.wv.vocab.keys())
+            import gensim
+            # large arrays saved apart by gensim are memory-mapped, only the rows read below are paged in
+            model = gensim.models.Word2Vec.load(options.word_vectors_bin, mmap='r')
+            # copy the needed rows into a compact matrix so that the full one can be released, keep at least one vector
+            # so that the size of the VST is still known when no token is in the vocabulary
+            l_known = [k for k in tokens if k in model.wv.vocab] or model.wv.index2word[:1]
+            vectors = numpy.asarray(model.wv.vectors[[model.wv.vocab[k].index for k in l_known]], dtype=numpy.float32)
+            word_vectors = dict(zip(l_known, vectors))
+            del model
         stderr.write('loading ontology: %s\n' % options.ontology)
         stderr.flush()
         ontology = onto.loadOnto(options.ontology)
-        for terms_i, regression_matrix_i, output_i, factor_i in zip(options.terms, options.regression_matrix, options.output, options.factors):
-            vso = onto.ontoToVec(ontology, factor_i)
-            stderr.write('loading terms: %s\n' % terms_i)
-            stderr.flush()
-            terms = loadJSON(terms_i)
+        # a VSONN is kept only while a later run still uses its factor
+        vsoNN_cache = dict()
+        for i, (terms, regression_matrix_i, output_i, factor_i) in enumerate(zip(l_terms, options.regression_matrix, options.output, options.factors)):
+            vsoNN = vsoNN_cache.pop(factor_i, None)
+            if vsoNN is None:
+                vsoNN = VSONN(onto.ontoToVec(ontology, factor_i), options.metric, options.ann, options.n_jobs)
+            if factor_i in options.factors[i + 1:]:
+                vsoNN_cache[factor_i] = vsoNN
             stderr.write('loading regression matrix: %s\n' % regression_matrix_i)
             stderr.flush()
             regression_matrix = joblib.load(regression_matrix_i)
             stderr.write('predicting\n')
             stderr.flush()
-            prediction, _ = predictor(word_vectors, terms, vso, regression_matrix, options.metric)
+            prediction, _ = predictor(word_vectors, terms, vsoNN.vso, regression_matrix, options.metric, vsoNN=vsoNN)
             stderr.write('writing predictions: %s\n' % output_i)
             stderr.flush()
-            f = open(output_i, 'w')
-            for _, term_id, concept_id, similarity in prediction:
-                f.write('%s\t%s\t%f\n' % (term_id, concept_id, similarity))
+            f = open(output_i, 'w', buffering=1 << 20)
+            f.write(''.join('%s\t%s\t%f\n' % (term_id, concept_id, similarity) for _, term_id, concept_id, similarity in prediction))
             f.close()
 
 if __name__ == '__main__':
@@ -1,2 +1,3 @@
 PYTHONPATH=/home/rbossy/code/CONTES ./main_predictor.py --word-vectors-bin test/word-vectors.bin --terms test/terms.json --ontology test/OntoBiotope_BioNLP-ST-2016.obo --regression-matrix test/regression-matrix.bin --output output.txt --factor 0.8
 
+PYTHONPATH=/home/rbossy/code/CONTES ./main_predictor.py --word-vectors-bin test/word-vectors.bin --terms test/terms-oov.json --ontology test/OntoBiotope_BioNLP-ST-2016.obo --regression-matrix test/regression-matrix.bin --output output-oov.txt --factor 0.8
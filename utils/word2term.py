@@ -92,13 +92,15 @@ def calculateTermVec(vst_onlyTokens, l_tokens, l_unknownToken):
     return vec, l_unknownToken
 
 
-def wordVST2TermVST(vst_onlyTokens, dl_terms):
+def wordVST2TermVST(vst_onlyTokens, dl_terms, dl_forms=None):
     """
     Description: Generate a new VST variable in which all terms from the dl_terms is expressed.
         Mathematically speaking, it is the same vector space than vst_onlyTokens, but the returned variable doesn't
         conserve the information of the tokens.
     :param vst_onlyTokens: An VST, but normally containing only vector for tokens.
     :param dl_terms: A dictionnary with id of terms for key and raw form of terms in value.
+    :param dl_forms: A dictionnary with id of terms for key and form of terms (see getFormOfTerm) in value, if the caller
+        already computed them.
     :return: A new VST.
     """
     vst = dict()
@@ -106,7 +108,10 @@ def wordVST2TermVST(vst_onlyTokens, dl_terms):
 
     for id_term in dl_terms.keys():
 
-        term = getFormOfTerm(dl_terms[id_term])
+        if dl_forms is None:
+            term = getFormOfTerm(dl_terms[id_term])
+        else:
+            term = dl_forms[id_term]
         vec, l_unknownToken = calculateTermVec(vst_onlyTokens, dl_terms[id_term], l_unknownToken)
 
         vst[term] = vec